@@ -0,0 +1,96 @@
+import itertools
+import json
+import os
+import pathlib
+import sqlite3
+import threading
+import time
+
+import dandi.dandiapi
+
+# Mirrors `DANDI_CACHE=ignore` from dandi-cli: results are still recorded, but never read back
+CACHE_IS_IGNORED = os.environ.get("BIDS_DANDISETS_CACHE", None) == "ignore"
+
+DANDISETS_CACHE_FILE_PATH = pathlib.Path.home() / ".cache" / "bids-dandisets" / "dandisets.json"
+# Seconds for which the DANDI listing is reused between runs of any script
+LISTING_MAX_AGE = float(os.environ.get("BIDS_DANDISETS_LISTING_MAX_AGE", 3600))
+
+
+def get_dandisets(
+    limit: int | None = None, max_age: float = LISTING_MAX_AGE, refresh: bool = False
+) -> dict[str, dict[str, str | int]]:
+    # The DANDI listing changes slowly, so runs within `max_age` seconds of each other reuse the last full listing
+    if refresh is False and CACHE_IS_IGNORED is False and DANDISETS_CACHE_FILE_PATH.exists():
+        content = json.loads(DANDISETS_CACHE_FILE_PATH.read_text())
+        if time.time() - content["fetched_at"] < max_age:
+            return dict(itertools.islice(content["dandisets"].items(), limit))
+
+    client = dandi.dandiapi.DandiAPIClient()
+    # Ordered server-side so a `limit` only pages through as much of the listing as needed
+    dandisets = {
+        dandiset.identifier: {
+            "version": dandiset.version.identifier,
+            "modified": dandiset.version.modified.isoformat(),
+            "asset_count": dandiset.version.asset_count,
+        }
+        for dandiset in itertools.islice(client.get_dandisets(order="id"), limit)
+    }
+
+    # Only a complete listing can answer later requests with any limit
+    if limit is None:
+        DANDISETS_CACHE_FILE_PATH.parent.mkdir(parents=True, exist_ok=True)
+        temporary_file_path = DANDISETS_CACHE_FILE_PATH.with_suffix(".tmp")
+        temporary_file_path.write_text(data=json.dumps(obj={"fetched_at": time.time(), "dandisets": dandisets}))
+        os.replace(src=temporary_file_path, dst=DANDISETS_CACHE_FILE_PATH)
+
+    return dandisets
+
+
+def get_dandiset_ids(limit: int | None = None, max_age: float = LISTING_MAX_AGE, refresh: bool = False) -> list[str]:
+    return list(get_dandisets(limit=limit, max_age=max_age, refresh=refresh))
+
+
+class RunInfoCache:
+    # Local lookups that spare the DANDI and GitHub APIs requests whose answers cannot have changed
+    def __init__(self, file_path: pathlib.Path) -> None:
+        self._connection = sqlite3.connect(database=file_path, check_same_thread=False)
+        self._connection.execute("CREATE TABLE IF NOT EXISTS run_info_blob (oid TEXT PRIMARY KEY, run_info TEXT)")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS nwb_dandiset ("
+            "dandiset_id TEXT PRIMARY KEY, dandiset_modified TEXT, is_nwb_dandiset INTEGER)"
+        )
+        self._connection.commit()
+        self._lock = threading.Lock()
+
+    # Blobs are addressed by their content hash, so these entries never go stale and are read even when ignoring
+    def get_blob(self, oid: str) -> dict | None:
+        with self._lock:
+            row = self._connection.execute("SELECT run_info FROM run_info_blob WHERE oid = ?", (oid,)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def set_blob(self, oid: str, run_info: dict) -> None:
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO run_info_blob VALUES (?, ?)", (oid, json.dumps(obj=run_info))
+            )
+            self._connection.commit()
+
+    # Whether a Dandiset holds NWB assets, as checked against the modified time it had then
+    def get_is_nwb_dandiset(self, dandiset_id: str, dandiset_modified: str) -> bool | None:
+        if CACHE_IS_IGNORED is True:
+            return None
+
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT is_nwb_dandiset FROM nwb_dandiset WHERE dandiset_id = ? AND dandiset_modified = ?",
+                (dandiset_id, dandiset_modified),
+            ).fetchone()
+        return bool(row[0]) if row is not None else None
+
+    def set_is_nwb_dandiset(self, dandiset_id: str, dandiset_modified: str, is_nwb_dandiset: bool) -> None:
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO nwb_dandiset VALUES (?, ?, ?)",
+                (dandiset_id, dandiset_modified, is_nwb_dandiset),
+            )
+            self._connection.commit()
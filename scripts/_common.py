@@ -0,0 +1,149 @@
+import collections.abc
+import concurrent.futures
+import functools
+import itertools
+import pathlib
+import subprocess
+
+import requests
+import requests.adapters
+import urllib3.exceptions
+import urllib3.response
+import urllib3.util
+
+# Passed per commit instead of written to each repository's config, which would cost two extra processes
+GIT_IDENTITY_OPTIONS = [
+    "-c",
+    "user.email=github-actions[bot]@users.noreply.github.com",
+    "-c",
+    "user.name=github-actions[bot]",
+]
+
+
+def deploy_subprocess(
+    *,
+    command: list[str],
+    cwd: str | pathlib.Path | None = None,
+    environment_variables: dict[str, str] | None = None,
+    error_message: str | None = None,
+    ignore_errors: bool = False,
+    return_combined_output: bool = False,
+    capture_stdout: bool = True,
+) -> str | None:
+    error_message = error_message or "An error occurred while executing the command."
+
+    # Argument lists are executed directly, without an intermediate shell
+    result = subprocess.run(
+        args=command,
+        cwd=cwd,
+        env=environment_variables,
+        # Commands that write their own output files can discard stdout instead of buffering it in memory
+        stdout=subprocess.PIPE if capture_stdout is True else subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+        encoding="utf-8",
+    )
+    if result.returncode != 0 and ignore_errors is False:
+        message = (
+            f"\n\nError code {result.returncode}\n"
+            f"{error_message}\n\n"
+            f"stdout: {result.stdout or ''}\n\n"
+            f"stderr: {result.stderr}\n\n"
+        )
+        raise RuntimeError(message)
+    if result.returncode != 0 and ignore_errors is True and return_combined_output is False:
+        return None
+
+    if return_combined_output is True:
+        combined_out = f"stdout: {result.stdout or ''}\nstderr: {result.stderr}"
+        return combined_out
+    else:
+        return result.stdout or ""
+
+
+class _RateLimitRetry(urllib3.util.Retry):
+    # GitHub also answers rate limits with 403, but other 403s are real permission errors and must fail immediately
+    def is_retry(self, method: str, status_code: int, has_retry_after: bool = False) -> bool:
+        if status_code == 403:
+            return bool(self.total) and self._is_method_retryable(method)
+
+        return super().is_retry(method=method, status_code=status_code, has_retry_after=has_retry_after)
+
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        # With `raise_on_status=False`, giving up here hands the 403 straight back to the caller
+        if response is not None and response.status == 403 and not _is_rate_limited(response=response):
+            raise urllib3.exceptions.MaxRetryError(pool=_pool, url=url, reason=None)
+
+        return super().increment(
+            method=method, url=url, response=response, error=error, _pool=_pool, _stacktrace=_stacktrace
+        )
+
+
+def _is_rate_limited(response: urllib3.response.HTTPResponse) -> bool:
+    return response.headers.get("X-RateLimit-Remaining", None) == "0" or "Retry-After" in response.headers
+
+
+@functools.cache
+def get_session(github_token: str) -> requests.Session:
+    # Created lazily so that each process builds its own connection pool
+    # Rate limits answer with 429, or with a 403 carrying rate limit headers, so those are waited out and retried
+    retries = _RateLimitRetry(
+        total=6,
+        backoff_factor=1.0,
+        status_forcelist=[429, 502, 503, 504],
+        allowed_methods=frozenset({"GET", "POST", "PUT", "DELETE"}),
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    # Only a handful of hosts are contacted, but the pool is shared by all preparation threads
+    adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=32, max_retries=retries)
+
+    session = requests.Session()
+    session.headers.update({"Authorization": f"token {github_token}"})
+    session.mount(prefix="https://", adapter=adapter)
+    return session
+
+
+def get_organization_repositories(github_token: str, organization: str = "bids-dandisets") -> set[str]:
+    # A hundred repositories per page, rather than one existence request per Dandiset
+    session = get_session(github_token=github_token)
+
+    repository_names = set()
+    url = f"https://api.github.com/orgs/{organization}/repos"
+    params = {"per_page": 100, "type": "all"}
+    while url is not None:
+        response = session.get(url=url, params=params)
+        response.raise_for_status()
+        repository_names.update(repository["name"] for repository in response.json())
+
+        # The next page URL already carries the query parameters
+        url = response.links.get("next", dict()).get("url", None)
+        params = None
+
+    return repository_names
+
+
+def run_until_first_failure(
+    function: collections.abc.Callable[[str], None], arguments: collections.abc.Iterable[str], max_workers: int
+) -> None:
+    # Tasks are submitted as workers free up, so after a failure only those already running finish before it is raised
+    remaining_arguments = iter(arguments)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(function, argument) for argument in itertools.islice(remaining_arguments, max_workers)
+        }
+        while len(futures) > 0:
+            done, futures = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                future.result()
+
+            futures |= {
+                executor.submit(function, argument) for argument in itertools.islice(remaining_arguments, len(done))
+            }
+
+
+def get_current_branch(cwd: pathlib.Path) -> str:
+    # Read HEAD directly rather than spawning `git branch`; a detached HEAD reports its abbreviated commit
+    head = (cwd / ".git" / "HEAD").read_text().strip()
+    current_branch = head.removeprefix("ref: refs/heads/") if head.startswith("ref: ") else head[:7]
+    return current_branch
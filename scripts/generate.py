@@ -1,16 +1,24 @@
 import collections
+import collections.abc
 import concurrent.futures
+import concurrent.futures.process
+import functools
 import importlib
 import importlib.metadata
+import itertools
 import json
+import multiprocessing
 import os
 import pathlib
 import shutil
-import subprocess
+import sys
+import threading
 import time
 import traceback
 import warnings
 
+import _cache
+import _common
 import dandi.dandiapi
 import nwb2bids
 import packaging.version
@@ -23,46 +31,89 @@ pynwb_warnings_to_suppress = [
     "Loaded namespace .+",
     "Support for automatic extraction of .+",
 ]
-for message in pynwb_warnings_to_suppress:
-    warnings.filterwarnings(action="ignore", category=UserWarning, message=message)
+# A single alternation keeps the filter list short, since every emitted warning is checked against it linearly
+warnings.filterwarnings(
+    action="ignore",
+    category=UserWarning,
+    message="|".join(f"(?:{pattern})" for pattern in pynwb_warnings_to_suppress),
+)
 
 LIMIT_SESSIONS = None
 
+# Lets CI or shared HPC nodes cap CPU use without changing the cron command
+MAX_WORKERS = os.environ.get("BIDS_DANDISETS_MAX_WORKERS", None)
+MAX_WORKERS = int(MAX_WORKERS) if MAX_WORKERS is not None else None
+
 GITHUB_TOKEN = os.environ.get("_GITHUB_API_KEY", None)
 if GITHUB_TOKEN is None:
     message = "`_GITHUB_API_KEY` environment variable not set"
     raise ValueError(message)
 
-if "site-packages" in importlib.util.find_spec("nwb2bids").origin:
-    message = "nwb2bids is installed in site-packages - please install in editable mode"
-    raise RuntimeError(message)
-
 BASE_GITHUB_URL = f"https://{GITHUB_TOKEN}@github.com"
 BASE_GITHUB_API_URL = "https://api.github.com/repos"
+GITHUB_GRAPHQL_URL = "https://api.github.com/graphql"
+GRAPHQL_BATCH_SIZE = 100
 RAW_CONTENT_BASE_URL = "https://raw.githubusercontent.com/bids-dandisets"
 
-BASE_DIRECTORY = pathlib.Path("/data/dandi/bids-dandisets/work")
+# Lets debugging and CI runs point at their own work area without editing this file
+BASE_DIRECTORY = pathlib.Path(os.environ.get("BIDS_DANDISETS_BASE_DIRECTORY", "/data/dandi/bids-dandisets/work"))
 
 # Cody's debugging
 # BASE_DIRECTORY = pathlib.Path("E:/GitHub/bids-dandisets/work")
 
 BASE_DIRECTORY.mkdir(exist_ok=True)
 
-AUTHENTICATION_HEADER = {"Authorization": f"token {GITHUB_TOKEN}"}
-
 PARALLEL_LOG_DIRECTORY = BASE_DIRECTORY / ".parallel_logs"
 PARALLEL_LOG_DIRECTORY.mkdir(exist_ok=True)
 
+HTTP_CACHE_FILE_PATH = PARALLEL_LOG_DIRECTORY / ".http_cache.json"
+RUN_INFO_CACHE_FILE_PATH = BASE_DIRECTORY / ".cache.sqlite"
+
+# Required for BIDs validation on inspection derivatives; serialized once and only the Dandiset ID is filled in
+DERIVATIVES_DATASET_DESCRIPTION_TEMPLATE = json.dumps(
+    obj={
+        "BIDSVersion": "1.10.0",
+        "DatasetType": "derivative",
+        "Name": "Inspections and Validations for BIDS-Dandiset {dandiset_id}",
+        "SourceDatasets": [{"URL": "../"}],
+    }
+)
+
+# Top-level entries of a BIDS-Dandiset that survive the cleanup before each conversion
+PROTECTED_NAMES = frozenset({".git", ".gitattributes", ".datalad", ".dandi", "dandiset.yaml", "derivatives"})
+
+# GitHub applies secondary rate limits to content creation, so only a couple of forks are requested at once
+_FORK_SEMAPHORE = threading.Semaphore(value=2)
+
+# Set once per worker process by `_init_worker` instead of being pickled with every submitted conversion
+_WORKER_RUN_INFO = None
+
+# The conversion pool shared by calls to `run` and the settings it was built with
+_EXECUTOR = None
+_EXECUTOR_KEY = None
+
 
 def run(
-    max_workers: int | None = None, limit: int | None = None, branch_name: str = "draft", force: bool = False
+    max_workers: int | None = None,
+    limit: int | None = None,
+    branch_name: str = "draft",
+    force: bool = False,
+    refresh_cache: bool = False,
 ) -> None:
-    version_tag_command = "git describe --tags --always"
+    # Checked here rather than at import so that conversion workers, which re-import this module, skip it
+    # Automated re-runs against a known environment can opt out of the lookup entirely
+    if (
+        os.environ.get("BIDS_DANDISETS_SKIP_DEV_CHECK", None) != "1"
+        and "site-packages" in importlib.util.find_spec("nwb2bids").origin
+    ):
+        message = "nwb2bids is installed in site-packages - please install in editable mode"
+        raise RuntimeError(message)
+
     nwb2bids_repo_path = pathlib.Path(nwb2bids.__file__).parents[1]
-    nwb2bids_version = _deploy_subprocess(command=version_tag_command, cwd=nwb2bids_repo_path).strip()
+    nwb2bids_version = _get_repo_version(repo_path=nwb2bids_repo_path)
     print(f"nwb2bids version: {nwb2bids_version}")
 
-    nwb2bids_branch = _get_current_branch(cwd=nwb2bids_repo_path)
+    nwb2bids_branch = _get_repo_branch(repo_path=nwb2bids_repo_path)
     print(f"nwb2bids branch: {nwb2bids_branch}\n\n")
 
     run_info = {
@@ -73,158 +124,427 @@ def run(
         "total_sessions": None,
     }
 
-    client = dandi.dandiapi.DandiAPIClient()
-    dandisets = list(client.get_dandisets())
-    dandisets.sort(key=lambda dandiset: int(dandiset.identifier))
+    dandiset_ids = _list_nwb_dandisets(limit=limit, refresh=refresh_cache)
 
-    if max_workers == 1:
-        for counter, dandiset in enumerate(dandisets):
-            if limit is not None and counter >= limit:
-                break
+    # Resolve which forks already exist, and their previous run info, in as few GitHub requests as possible
+    # Run info blobs are cached by their oid, so unchanged forks cost no more than their share of a batched query
+    repo_states = _prefetch_repo_states(dandiset_ids=dandiset_ids, branch_name=branch_name)
 
-            if len(list(dandiset.get_assets())) == 0:
-                print(f"Skipping Dandiset {dandiset.identifier} - no assets found!\n\n")
-                continue
+    # Dandisets already known to be up to date are dropped here rather than dispatched only to return early
+    outdated_dandiset_ids = []
+    for dandiset_id in dandiset_ids:
+        repo_state = repo_states.get(dandiset_id, None)
+        if repo_state is not None and not _needs_update(
+            previous_run_info=repo_state["run_info"], run_info=run_info, force=force
+        ):
+            print(f"Skipping {dandiset_id} - already up to date!\n\n")
+            continue
 
-            data_standards = dandiset.get_raw_metadata().get("assetsSummary", dict()).get("dataStandard", list())
-            if not any(data_standard["identifier"] == "RRID:SCR_015242" for data_standard in data_standards):
-                print(f"Skipping Dandiset {dandiset.identifier} - no NWB assets found!\n\n")
-                continue
+        outdated_dandiset_ids.append(dandiset_id)
+    dandiset_ids = outdated_dandiset_ids
 
-            dandiset_id = dandiset.identifier
+    if max_workers == 1:
+        _init_worker(run_info=tuple(run_info.items()))
+        for dandiset_id in dandiset_ids:
             repo_directory = BASE_DIRECTORY / dandiset_id
 
-            _convert_dandiset(
+            is_prepared = _prepare_dandiset(
                 dandiset_id=dandiset_id,
                 repo_directory=repo_directory,
                 run_info=run_info,
                 branch_name=branch_name,
                 force=force,
+                repo_state=repo_states.get(dandiset_id, None),
             )
-    elif max_workers is None or max_workers != 0:
-        with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
-            futures = []
-
-            for counter, dandiset in enumerate(dandisets):
-                if limit is not None and counter >= limit:
-                    break
-
-                if len(list(dandiset.get_assets())) == 0:
-                    print(f"Skipping Dandiset {dandiset.identifier} - no assets found!\n\n")
-                    continue
-
-                data_standards = dandiset.get_raw_metadata().get("assetsSummary", dict()).get("dataStandard", list())
-                if not any(data_standard["identifier"] == "RRID:SCR_015242" for data_standard in data_standards):
-                    print(f"Skipping Dandiset {dandiset.identifier} - no NWB assets found!\n\n")
-                    continue
-
-                dandiset_id = dandiset.identifier
-                repo_directory = BASE_DIRECTORY / dandiset_id
+            if is_prepared is not True:
+                continue
 
-                futures.append(
-                    executor.submit(
-                        _convert_dandiset,
+            is_converted = _convert_dandiset(
+                dandiset_id=dandiset_id, repo_directory=repo_directory, branch_name=branch_name
+            )
+            if is_converted is True:
+                _push_dandiset(dandiset_id=dandiset_id, repo_directory=repo_directory, branch_name=branch_name)
+    elif max_workers is None or max_workers != 0:
+        # GitHub requests and git clones/fetches are I/O-bound, so they run on threads in this process
+        # Only the CPU-bound conversions are handed to the process pool, which then never idles on the network
+        executor = _get_executor(max_workers=max_workers, run_info=tuple(run_info.items()))
+        max_preparations = 16
+        with (
+            concurrent.futures.ThreadPoolExecutor(max_workers=max_preparations) as preparation_executor,
+            concurrent.futures.ThreadPoolExecutor(max_workers=4) as push_executor,
+        ):
+            remaining_dandiset_ids = iter(dandiset_ids)
+            preparation_futures = dict()
+            conversion_futures = dict()
+
+            def _submit_preparations(count: int) -> None:
+                for dandiset_id in itertools.islice(remaining_dandiset_ids, count):
+                    preparation_future = preparation_executor.submit(
+                        _prepare_dandiset,
                         dandiset_id=dandiset_id,
-                        repo_directory=repo_directory,
+                        repo_directory=BASE_DIRECTORY / dandiset_id,
                         run_info=run_info,
                         branch_name=branch_name,
                         force=force,
+                        repo_state=repo_states.get(dandiset_id, None),
                     )
-                )
+                    preparation_futures[preparation_future] = dandiset_id
+
+            # Uploads are network-bound, so they overlap with the conversions that follow instead of occupying a worker
+            def _submit_pushes(return_when: str) -> None:
+                done, _ = concurrent.futures.wait(conversion_futures, return_when=return_when)
+                for conversion_future in done:
+                    dandiset_id = conversion_futures.pop(conversion_future)
+                    # A worker that died outright (e.g., out of memory) surfaces as an exception on its future
+                    if conversion_future.exception() is not None:
+                        print(f"Conversion of {dandiset_id} failed: {conversion_future.exception()!r}\n\n")
+                    elif conversion_future.result() is True:
+                        push_executor.submit(
+                            _push_dandiset,
+                            dandiset_id=dandiset_id,
+                            repo_directory=BASE_DIRECTORY / dandiset_id,
+                            branch_name=branch_name,
+                        )
+
+            # Both stages use sliding windows so the parent holds O(workers) pending jobs rather than O(N)
+            max_in_flight = 2 * (max_workers or os.cpu_count())
+            _submit_preparations(count=2 * max_preparations)
+            while len(preparation_futures) > 0:
+                done, _ = concurrent.futures.wait(preparation_futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                for preparation_future in done:
+                    dandiset_id = preparation_futures.pop(preparation_future)
+                    if preparation_future.result() is not True:
+                        continue
+
+                    while len(conversion_futures) >= max_in_flight:
+                        _submit_pushes(return_when=concurrent.futures.FIRST_COMPLETED)
+
+                    conversion_kwargs = {
+                        "dandiset_id": dandiset_id,
+                        "repo_directory": BASE_DIRECTORY / dandiset_id,
+                        "branch_name": branch_name,
+                    }
+                    try:
+                        conversion_future = executor.submit(_convert_dandiset, **conversion_kwargs)
+                    except concurrent.futures.process.BrokenProcessPool:
+                        # A dead worker breaks the whole pool for good, so it is replaced before continuing
+                        print("Conversion pool broken by a dead worker - starting a new one...\n\n")
+                        _shutdown_executor()
+                        executor = _get_executor(max_workers=max_workers, run_info=tuple(run_info.items()))
+                        conversion_future = executor.submit(_convert_dandiset, **conversion_kwargs)
+                    conversion_futures[conversion_future] = dandiset_id
+                _submit_preparations(count=len(done))
+
+            _submit_pushes(return_when=concurrent.futures.ALL_COMPLETED)
+
+    _get_http_cache().save()
+
+
+def _list_nwb_dandisets(limit: int | None, refresh: bool = False) -> list[str]:
+    # The shared DANDI listing is filtered here; each check is kept until its Dandiset is modified again
+    dandisets = _cache.get_dandisets(limit=limit, refresh=refresh)
+    is_nwb_dandisets = {
+        dandiset_id: _get_run_info_cache().get_is_nwb_dandiset(
+            dandiset_id=dandiset_id, dandiset_modified=dandiset["modified"]
+        )
+        for dandiset_id, dandiset in dandisets.items()
+    }
+    unchecked_dandiset_ids = [dandiset_id for dandiset_id, is_nwb in is_nwb_dandisets.items() if is_nwb is None]
+
+    # Each metadata lookup is a separate DANDI API request, so they are overlapped on threads
+    client = dandi.dandiapi.DandiAPIClient()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=16) as metadata_executor:
+        checks = metadata_executor.map(
+            functools.partial(_is_nwb_dandiset, client=client),
+            unchecked_dandiset_ids,
+            [dandisets[dandiset_id] for dandiset_id in unchecked_dandiset_ids],
+        )
+        for dandiset_id, is_nwb_dandiset in zip(unchecked_dandiset_ids, checks):
+            is_nwb_dandisets[dandiset_id] = is_nwb_dandiset
+            _get_run_info_cache().set_is_nwb_dandiset(
+                dandiset_id=dandiset_id,
+                dandiset_modified=dandisets[dandiset_id]["modified"],
+                is_nwb_dandiset=is_nwb_dandiset,
+            )
 
-            collections.deque(concurrent.futures.as_completed(futures), maxlen=0)
+    return [dandiset_id for dandiset_id, is_nwb_dandiset in is_nwb_dandisets.items() if is_nwb_dandiset is True]
 
 
-def _convert_dandiset(
-    dandiset_id: str, repo_directory: pathlib.Path, run_info: dict, branch_name: str, force: bool = False
-) -> None:
+def _is_nwb_dandiset(dandiset_id: str, dandiset: dict, client: dandi.dandiapi.DandiAPIClient) -> bool:
+    # The listing already reports the asset count, so the assets themselves are never paged through
+    if dandiset["asset_count"] == 0:
+        print(f"Skipping Dandiset {dandiset_id} - no assets found!\n\n")
+        return False
+
+    raw_metadata = client.get_dandiset(dandiset_id=dandiset_id, version_id=dandiset["version"]).get_raw_metadata()
+    data_standards = raw_metadata.get("assetsSummary", dict()).get("dataStandard", list())
+    if not any(data_standard["identifier"] == "RRID:SCR_015242" for data_standard in data_standards):
+        print(f"Skipping Dandiset {dandiset_id} - no NWB assets found!\n\n")
+        return False
+
+    return True
+
+
+def _prefetch_repo_states(dandiset_ids: list[str], branch_name: str) -> dict[str, dict]:
+    run_info_object = f'object(expression: "{branch_name}:.nwb2bids/run_info.json")'
+    repositories = _query_repositories(
+        dandiset_ids=dandiset_ids, selection=f"{run_info_object} {{ ... on Blob {{ oid }} }}"
+    )
+
+    # Unresolved Dandisets are left out of the map so that workers fall back to the REST check
+    repo_states = dict()
+    for dandiset_id, repository in repositories.items():
+        if repository is None:
+            repo_states[dandiset_id] = {"exists": False, "run_info_oid": None, "run_info": None}
+            continue
+
+        blob = repository["object"] or dict()
+        run_info_oid = blob.get("oid", None)
+        repo_states[dandiset_id] = {
+            "exists": True,
+            "run_info_oid": run_info_oid,
+            "run_info": _get_run_info_cache().get_blob(oid=run_info_oid) if run_info_oid is not None else None,
+        }
+
+    # Only run info blobs that have never been seen before are downloaded
+    unseen_dandiset_ids = [
+        dandiset_id
+        for dandiset_id, repo_state in repo_states.items()
+        if repo_state["run_info_oid"] is not None and repo_state["run_info"] is None
+    ]
+    repositories = _query_repositories(
+        dandiset_ids=unseen_dandiset_ids,
+        selection=f"{run_info_object} {{ ... on Blob {{ oid text }} }}",
+    )
+    for dandiset_id, repository in repositories.items():
+        blob = (repository or dict()).get("object", None) or dict()
+        if blob.get("text", None) is None:
+            continue
+
+        run_info = json.loads(blob["text"])
+        _get_run_info_cache().set_blob(oid=blob["oid"], run_info=run_info)
+        repo_states[dandiset_id]["run_info_oid"] = blob["oid"]
+        repo_states[dandiset_id]["run_info"] = run_info
+
+    # A blob that could not be downloaded would read as missing run info, so those workers fall back to the REST check
+    for dandiset_id in unseen_dandiset_ids:
+        if repo_states[dandiset_id]["run_info"] is None:
+            del repo_states[dandiset_id]
+
+    return repo_states
+
+
+def _query_repositories(dandiset_ids: list[str], selection: str) -> dict[str, dict | None]:
+    # Repositories that do not exist map to None; those that could not be resolved are left out
+    session = _common.get_session(github_token=GITHUB_TOKEN)
+
+    repositories = dict()
+    for start in range(0, len(dandiset_ids), GRAPHQL_BATCH_SIZE):
+        batch = dandiset_ids[start : start + GRAPHQL_BATCH_SIZE]
+        fields = "\n".join(
+            f'repo_{dandiset_id}: repository(owner: "bids-dandisets", name: "{dandiset_id}") {{ {selection} }}'
+            for dandiset_id in batch
+        )
+        response = session.post(url=GITHUB_GRAPHQL_URL, json={"query": f"query {{\n{fields}\n}}"})
+        if response.status_code != 200:
+            # Gateway errors that outlast the retries usually carry an HTML page rather than JSON
+            try:
+                message = response.json()["message"]
+            except requests.exceptions.JSONDecodeError:
+                message = response.text
+            print(f"Status code {response.status_code}: {message}")
+            continue
+
+        content = response.json()
+        data = content.get("data", None)
+        if data is None:
+            continue
+
+        not_found = {
+            error["path"][0] for error in content.get("errors", list()) if error.get("type", None) == "NOT_FOUND"
+        }
+        for dandiset_id in batch:
+            alias = f"repo_{dandiset_id}"
+            repository = data.get(alias, None)
+            if repository is not None:
+                repositories[dandiset_id] = repository
+            elif alias in not_found:
+                repositories[dandiset_id] = None
+
+    return repositories
+
+
+def _prepare_dandiset(
+    dandiset_id: str,
+    repo_directory: pathlib.Path,
+    run_info: dict,
+    branch_name: str,
+    force: bool = False,
+    repo_state: dict | None = None,
+) -> bool:
     try:
         print(f"Processing Dandiset {dandiset_id}...")
 
         repo_name = f"bids-dandisets/{dandiset_id}"
         repo_api_url = f"{BASE_GITHUB_API_URL}/{repo_name}"
-        response = requests.get(url=repo_api_url, headers=AUTHENTICATION_HEADER)
-        if response.status_code != 200:
-            print(f"Status code {response.status_code}: {response.json()["message"]}")
+        if repo_state is not None:
+            repo_exists = repo_state["exists"]
+        else:
+            status_code, content = _get_http_cache().get(url=repo_api_url)
+            if status_code != 200:
+                print(f"Status code {status_code}: {content["message"]}")
 
-            if response.status_code == 403:  # TODO: Not sure how to handle this yet
-                return
+                if status_code == 403:  # Access denied, or still rate limited after every retry
+                    return False
+            repo_exists = status_code == 200
 
+        if repo_exists is False:
             print(f"\tForking GitHub repository for {dandiset_id} ...")
 
             repo_fork_url = f"https://api.github.com/repos/dandisets/{dandiset_id}/forks"
-            headers = {"Authorization": f"token {GITHUB_TOKEN}", "Accept": "application/vnd.github+json"}
+            headers = {"Accept": "application/vnd.github+json"}
             data = {"organization": "bids-dandisets"}
-            response = requests.post(url=repo_fork_url, headers=headers, json=data)
-            if response.status_code != 202:
-                print(f"\tStatus code {response.status_code}: {response.json()['message']}")
+            with _FORK_SEMAPHORE:
+                response = _common.get_session(github_token=GITHUB_TOKEN).post(
+                    url=repo_fork_url, headers=headers, json=data
+                )
+                if response.status_code != 202:
+                    print(f"\tStatus code {response.status_code}: {response.json()['message']}")
 
-                return
-            time.sleep(30)  # Give it some time to complete
+                    return False
+                _wait_for_fork(repo_api_url=repo_api_url)
 
         # Decide whether to skip based on hidden details of generation runs
-        run_info_url = f"{RAW_CONTENT_BASE_URL}/{dandiset_id}/{branch_name}/.nwb2bids/run_info.json"
-        response = requests.get(url=run_info_url, headers=AUTHENTICATION_HEADER)
-        if response.status_code == 200:
-            previous_run_info = response.json()
+        # Always read from the remote; a local commit whose push failed would otherwise look up to date forever
+        if repo_state is not None:
+            previous_run_info = repo_state["run_info"]
+        else:
+            run_info_url = f"{RAW_CONTENT_BASE_URL}/{dandiset_id}/{branch_name}/.nwb2bids/run_info.json"
+            status_code, content = _get_http_cache().get(url=run_info_url)
+            if status_code == 403:  # Access denied, or still rate limited after every retry
+                return False
 
-            previous_nwb2bids_version = packaging.version.Version(
-                version="-".join(previous_run_info.get("nwb2bids_version", "").removeprefix("v").split("-")[:2])
-            )
-            current_version = packaging.version.Version(
-                version="-".join(run_info["nwb2bids_version"].removeprefix("v").split("-")[:2])
-            )
+            previous_run_info = content if status_code == 200 else None
 
-            previous_session_limit = previous_run_info.get("limit", None) or 0
-            session_limit_not_exceeded = LIMIT_SESSIONS is None or LIMIT_SESSIONS <= previous_session_limit
-            if force is False and previous_nwb2bids_version >= current_version and session_limit_not_exceeded:
-                print(f"Skipping {dandiset_id} - already up to date!\n\n")
+        if not _needs_update(previous_run_info=previous_run_info, run_info=run_info, force=force):
+            print(f"Skipping {dandiset_id} - already up to date!\n\n")
 
-                return
-        elif response.status_code == 403:  # TODO: Not sure how to handle this yet
-            return
+            return False
 
         # Clone the repo or fetch the latest changes
+        fetch_output = None
         if not repo_directory.exists():
             print(f"\tCloning GitHub repository for Dandiset {dandiset_id}...")
 
             repo_url = f"{BASE_GITHUB_URL}/{repo_name}"
-            _deploy_subprocess(command=f"git clone {repo_url}", cwd=BASE_DIRECTORY)
+            # Only the tip of the target branch is needed since the content is regenerated from scratch
+            clone_command = [
+                "git",
+                "-C",
+                str(BASE_DIRECTORY),
+                "-c",
+                "protocol.version=2",
+                "clone",
+                "--depth=1",
+                "--single-branch",
+                "--filter=blob:none",
+            ]
+            clone_output = _common.deploy_subprocess(
+                command=[*clone_command, "--branch", branch_name, repo_url], ignore_errors=True, capture_stdout=False
+            )
+
+            # The branch may not exist on the remote yet, in which case it is created from the default branch
+            if clone_output is None:
+                _common.deploy_subprocess(command=[*clone_command, repo_url], capture_stdout=False)
         else:
-            _deploy_subprocess(command="git fetch", cwd=repo_directory)
+            # Only the tip of the target branch is needed; the branch may not exist on the remote yet
+            fetch_command = [
+                "git",
+                "-C",
+                str(repo_directory),
+                "fetch",
+                "--depth=1",
+                "--filter=blob:none",
+                "--no-tags",
+                "origin",
+                branch_name,
+            ]
+            fetch_output = _common.deploy_subprocess(command=fetch_command, ignore_errors=True, capture_stdout=False)
 
         print(f"\tChecking out branch {branch_name}...")
 
-        output = _deploy_subprocess(
-            command=f"git checkout {branch_name}",
-            cwd=repo_directory,
+        output = _common.deploy_subprocess(
+            command=["git", "-C", str(repo_directory), "checkout", branch_name],
             return_combined_output=True,
             ignore_errors=True,
         )
         if "error" in output:
-            output = _deploy_subprocess(command=f"git checkout -b {branch_name}", cwd=repo_directory)
+            output = _common.deploy_subprocess(
+                command=["git", "-C", str(repo_directory), "checkout", "-b", branch_name]
+            )
         if "error" in output:
             message = f"Could not checkout or create branch {branch_name}!"
             raise RuntimeError(message)
 
-        current_branch = _get_current_branch(cwd=repo_directory)
+        current_branch = _common.get_current_branch(cwd=repo_directory)
         if current_branch != branch_name:
             message = f"Current branch ({current_branch}) does not equal target ({branch_name})!"
             raise RuntimeError(message)
 
-        _deploy_subprocess(command="git pull", cwd=repo_directory, ignore_errors=True)
+        if fetch_output is not None:
+            _common.deploy_subprocess(
+                command=["git", "-C", str(repo_directory), "reset", "--hard", "FETCH_HEAD"], capture_stdout=False
+            )
 
         print(f"\tCleaning up {dandiset_id}...")
 
-        paths_to_clean = {path for path in repo_directory.iterdir()} - {
-            repo_directory / path for path in [".git", ".gitattributes", ".datalad", ".dandi", "dandiset.yaml"]
-        }
-        for path in paths_to_clean:
-            if path.is_dir():
-                shutil.rmtree(path=path)
-            else:
-                path.unlink()
+        with os.scandir(repo_directory) as entries:
+            entries_to_clean = [entry for entry in entries if entry.name not in PROTECTED_NAMES]
+        _remove_entries(entries=entries_to_clean)
+
+        return True
+    except Exception as exception:
+        _log_exception(dandiset_id=dandiset_id, branch_name=branch_name, exception=exception)
+
+        return False
+
+
+def _needs_update(previous_run_info: dict | None, run_info: dict, force: bool = False) -> bool:
+    if force is True or previous_run_info is None:
+        return True
+
+    previous_nwb2bids_version = _parse_nwb2bids_version(version_tag=previous_run_info.get("nwb2bids_version", ""))
+    current_version = _parse_nwb2bids_version(version_tag=run_info["nwb2bids_version"])
+
+    previous_session_limit = previous_run_info.get("limit", None) or 0
+    session_limit_not_exceeded = LIMIT_SESSIONS is None or LIMIT_SESSIONS <= previous_session_limit
+    return not (previous_nwb2bids_version >= current_version and session_limit_not_exceeded)
+
+
+@functools.cache
+def _get_repo_version(repo_path: pathlib.Path) -> str:
+    # Repeated `run` calls in one session reuse the tag instead of spawning `git describe` again
+    version_tag_command = ["git", "-C", str(repo_path), "describe", "--tags", "--always"]
+    return _common.deploy_subprocess(command=version_tag_command).strip()
+
+
+def _get_repo_branch(repo_path: pathlib.Path) -> str:
+    # Unlike the Dandiset clones, nwb2bids may sit below its worktree root or in a worktree whose `.git` is a file
+    git_command = ["git", "-C", str(repo_path), "rev-parse"]
+    branch = _common.deploy_subprocess(command=[*git_command, "--abbrev-ref", "HEAD"]).strip()
+    if branch == "HEAD":
+        branch = _common.deploy_subprocess(command=[*git_command, "--short=7", "HEAD"]).strip()
+    return branch
+
+
+@functools.cache
+def _parse_nwb2bids_version(version_tag: str) -> packaging.version.Version:
+    # The current version is compared against every Dandiset, and most previous runs share a handful of tags
+    return packaging.version.Version(version="-".join(version_tag.removeprefix("v").split("-")[:2]))
+
 
+def _convert_dandiset(dandiset_id: str, repo_directory: pathlib.Path, branch_name: str) -> bool:
+    try:
         print(f"\tConverting {dandiset_id}...")
 
         if branch_name == "draft":
@@ -248,66 +568,148 @@ def _convert_dandiset(
 
         print(f"Updating draft of {dandiset_id} ...")
 
-        _write_bids_dandiset(dataset_converter=dataset_converter, repo_directory=repo_directory, run_info=run_info)
-
-        _configure_git_repo(repo_directory=repo_directory)
-        _push_changes(repo_directory=repo_directory, branch_name=branch_name)
+        _write_bids_dandiset(
+            dataset_converter=dataset_converter, repo_directory=repo_directory, run_info=_WORKER_RUN_INFO
+        )
 
         # TODO: only make other branches for config options like sanitization
         # try:
-        #     _deploy_subprocess(command=f"git checkout -b {nwb2bids_version}", cwd=repo_directory)
+        #     _deploy_subprocess(command=["git", "-C", str(repo_directory), "checkout", "-b", nwb2bids_version])
         # except RuntimeError:
-        #     _deploy_subprocess(command=f"git checkout {nwb2bids_version}", cwd=repo_directory)
+        #     _deploy_subprocess(command=["git", "-C", str(repo_directory), "checkout", nwb2bids_version])
         #
         #     print("\tUpdating commit branch...")
         #     _write_bids_dandiset(
-        #         dataset_converter=dataset_converter, repo_directory=repo_directory, run_info=run_info
+        #         dataset_converter=dataset_converter, repo_directory=repo_directory, run_info=_WORKER_RUN_INFO
         #     )
         # _push_changes(repo_directory=repo_directory, branch_name=nwb2bids_version)
 
+        return True
+    except Exception as exception:
+        _log_exception(dandiset_id=dandiset_id, branch_name=branch_name, exception=exception)
+
+        return False
+
+
+def _push_dandiset(dandiset_id: str, repo_directory: pathlib.Path, branch_name: str) -> None:
+    try:
+        _push_changes(repo_directory=repo_directory, branch_name=branch_name)
+
         print(f"Process complete for Dandiset {dandiset_id}!\n\n")
     except Exception as exception:
-        log_file_path = PARALLEL_LOG_DIRECTORY / f"{dandiset_id}_{branch_name}.log"
-        with log_file_path.open(mode="w") as file_stream:
-            file_stream.write(f"{type(exception)}: {str(exception)}\n\n{traceback.format_exc()}")
-
-
-def _deploy_subprocess(
-    *,
-    command: str | list[str],
-    cwd: str | pathlib.Path | None = None,
-    environment_variables: dict[str, str] | None = None,
-    error_message: str | None = None,
-    ignore_errors: bool = False,
-    return_combined_output: bool = False,
-) -> str | None:
-    error_message = error_message or "An error occurred while executing the command."
-
-    result = subprocess.run(
-        args=command,
-        cwd=cwd,
-        shell=True,
-        env=environment_variables,
-        capture_output=True,
-        text=True,
-        encoding="utf-8",
+        _log_exception(dandiset_id=dandiset_id, branch_name=branch_name, exception=exception)
+
+
+def _log_exception(dandiset_id: str, branch_name: str, exception: Exception) -> None:
+    log_file_path = PARALLEL_LOG_DIRECTORY / f"{dandiset_id}_{branch_name}.log"
+    with log_file_path.open(mode="w") as file_stream:
+        file_stream.write(f"{type(exception)}: {str(exception)}\n\n{traceback.format_exc()}")
+
+
+def _get_executor(
+    max_workers: int | None, run_info: tuple[tuple[str, object], ...]
+) -> concurrent.futures.ProcessPoolExecutor:
+    # Reused across calls to `run`, and workers are kept for its lifetime so heavy imports are paid once per worker
+    # Only one pool is kept alive; a pool built for other settings is shut down before it is replaced
+    global _EXECUTOR, _EXECUTOR_KEY
+
+    executor_key = (max_workers, run_info)
+    if _EXECUTOR is not None and _EXECUTOR_KEY == executor_key:
+        return _EXECUTOR
+    _shutdown_executor()
+
+    mp_context = None
+    if sys.platform == "linux":
+        # The fork server imports the NWB stack once and every worker is forked from it already warm
+        mp_context = multiprocessing.get_context(method="forkserver")
+        mp_context.set_forkserver_preload(["nwb2bids", "pynwb", "h5py"])
+
+    _EXECUTOR = concurrent.futures.ProcessPoolExecutor(
+        max_workers=max_workers, mp_context=mp_context, initializer=_init_worker, initargs=(run_info,)
     )
-    if result.returncode != 0 and ignore_errors is False:
-        message = (
-            f"\n\nError code {result.returncode}\n"
-            f"{error_message}\n\n"
-            f"stdout: {result.stdout}\n\n"
-            f"stderr: {result.stderr}\n\n"
-        )
-        raise RuntimeError(message)
-    if result.returncode != 0 and ignore_errors is True and return_combined_output is False:
-        return None
+    _EXECUTOR_KEY = executor_key
+    return _EXECUTOR
 
-    if return_combined_output is True:
-        combined_out = f"stdout: {result.stdout}\nstderr: {result.stderr}"
-        return combined_out
-    else:
-        return result.stdout
+
+def _shutdown_executor() -> None:
+    global _EXECUTOR, _EXECUTOR_KEY
+
+    if _EXECUTOR is not None:
+        _EXECUTOR.shutdown(wait=True, cancel_futures=True)
+    _EXECUTOR = None
+    _EXECUTOR_KEY = None
+
+
+def _init_worker(run_info: tuple[tuple[str, object], ...]) -> None:
+    global _WORKER_RUN_INFO
+
+    _WORKER_RUN_INFO = dict(run_info)
+
+
+def _wait_for_fork(repo_api_url: str) -> None:
+    # Forks are usually ready within a few seconds; back off instead of always sleeping for the worst case
+    delays = (1, 2, 4, 8, 15, 30)
+    for delay in delays:
+        time.sleep(delay)
+
+        response = _common.get_session(github_token=GITHUB_TOKEN).get(url=repo_api_url)
+        if response.status_code == 200:
+            return
+
+    message = f"Fork at {repo_api_url} not visible after {sum(delays)} seconds!"
+    raise RuntimeError(message)
+
+
+class ConditionalCache:
+    # Maps each URL to the validators and parsed JSON content of the last successful response
+    def __init__(self, file_path: pathlib.Path) -> None:
+        self.file_path = file_path
+        self._entries = json.loads(file_path.read_text()) if file_path.exists() else dict()
+        self._lock = threading.Lock()
+
+    def get(self, url: str) -> tuple[int, dict | None]:
+        with self._lock:
+            entry = self._entries.get(url, None)
+
+        headers = dict()
+        if entry is not None and entry["etag"] is not None:
+            headers["If-None-Match"] = entry["etag"]
+        if entry is not None and entry["last_modified"] is not None:
+            headers["If-Modified-Since"] = entry["last_modified"]
+
+        # A 304 carries no body and does not count against the REST rate limit
+        response = _common.get_session(github_token=GITHUB_TOKEN).get(url=url, headers=headers)
+        if response.status_code == 304:
+            return 200, entry["content"]
+        if response.status_code != 200:
+            try:
+                return response.status_code, response.json()
+            except requests.exceptions.JSONDecodeError:
+                return response.status_code, {"message": response.text}
+
+        content = response.json()
+        etag = response.headers.get("ETag", None)
+        last_modified = response.headers.get("Last-Modified", None)
+        if etag is not None or last_modified is not None:
+            with self._lock:
+                self._entries[url] = {"etag": etag, "last_modified": last_modified, "content": content}
+        return 200, content
+
+    def save(self) -> None:
+        with self._lock:
+            temporary_file_path = self.file_path.with_suffix(".tmp")
+            temporary_file_path.write_text(data=json.dumps(obj=self._entries))
+            os.replace(src=temporary_file_path, dst=self.file_path)
+
+
+@functools.cache
+def _get_http_cache() -> ConditionalCache:
+    return ConditionalCache(file_path=HTTP_CACHE_FILE_PATH)
+
+
+@functools.cache
+def _get_run_info_cache() -> _cache.RunInfoCache:
+    return _cache.RunInfoCache(file_path=RUN_INFO_CACHE_FILE_PATH)
 
 
 def _write_bids_dandiset(
@@ -326,25 +728,18 @@ def _write_bids_dandiset(
     # nwb_inspection_file_path = inspections_directory / f"src-nwb-inspector_ver-{nwb_inspector_version}.txt"
     # dandi_validation_file_path = validations_directory / "dandi_validation.txt"
 
-    # Cleanup existing content from original fork or previous runs
-    current_content = [path for path in repo_directory.iterdir() if not path.name.startswith(".") and path.is_dir()]
-    for path in current_content:
-        shutil.rmtree(path=path)
-    if derivatives_directory.exists():
-        shutil.rmtree(path=derivatives_directory)
+    # Content from the original fork or previous runs was already removed by `_prepare_dandiset`
+    # Derivatives are pruned in place so that files rewritten with identical content do not dirty the working tree
     derivatives_directory.mkdir(exist_ok=True)
+    _prune_directory(directory=derivatives_directory, keep={derivatives_dataset_description_file_path})
     validations_directory.mkdir(exist_ok=True)
 
     dataset_converter.convert_to_bids_dataset()
 
-    # Required for BIDs validation on inspection derivatives
-    derivatives_dataset_description = {
-        "BIDSVersion": "1.10.0",
-        "DatasetType": "derivative",
-        "Name": f"Inspections and Validations for BIDS-Dandiset {repo_directory.stem}",
-        "SourceDatasets": [{"URL": "../"}],
-    }
-    derivatives_dataset_description_file_path.write_text(json.dumps(obj=derivatives_dataset_description))
+    _write_if_changed(
+        file_path=derivatives_dataset_description_file_path,
+        data=DERIVATIVES_DATASET_DESCRIPTION_TEMPLATE.replace("{dandiset_id}", repo_directory.stem).encode(),
+    )
 
     # notifications_dump = [notification.model_dump(mode="json") for notification in dataset_converter.messages]
     # if len(notifications_dump) > 0:
@@ -359,13 +754,23 @@ def _write_bids_dandiset(
 
     # _deploy_subprocess(command=f"dandi validate {repo_directory} > {dandi_validation_file_path}", ignore_errors=True)
 
+    # Single pass over the converted repository for both the session count and the manifest
+    # Paths are streamed to the manifest as they are found rather than collected into a list first
+    session_subdirectories = set()
+    with manifest_file_path.open(mode="w", buffering=1 << 20) as file_stream:
+        separator = ""
+        for relative_path, is_directory, name in _fast_walk(root=repo_directory):
+            if not is_directory:
+                file_stream.write(f"{separator}{relative_path}")
+                separator = "\n"
+            if name.endswith(".nwb"):
+                parts = relative_path.split("/")
+                session_subdirectories.update(
+                    "/".join(parts[: index + 1]) for index, part in enumerate(parts[:-1]) if "ses-" in part
+                )
+
     # Write last as a sign of completion
     dandiset_run_info = run_info.copy()
-    session_subdirectories = {
-        path
-        for path in repo_directory.rglob(pattern="*ses-*")
-        if path.is_dir() and len(set(path.rglob(pattern="*.nwb"))) > 0
-    }
     dandiset_run_info["sessions_converted"] = len(session_subdirectories)
     if LIMIT_SESSIONS is None:
         dandiset_run_info["total_sessions"] = len(dataset_converter.session_converters)
@@ -374,58 +779,101 @@ def _write_bids_dandiset(
     elif LIMIT_SESSIONS is not None and dandiset_run_info["sessions_converted"] == LIMIT_SESSIONS:
         dandiset_run_info["total_sessions"] = "???"
 
-    with run_info_file_path.open(mode="w") as file_stream:
-        json.dump(obj=dandiset_run_info, fp=file_stream, indent=2)
-
-    # Also dump manifest
-    files = []
-    for root, _, filenames in repo_directory.walk():
-        for filename in filenames:
-            file_path = pathlib.Path(root) / filename
-            relative_path = file_path.relative_to(repo_directory)
-            files.append(relative_path.as_posix())
-    non_hidden_files = [file for file in files if not any(part.startswith(".") for part in file.split("/"))]
-    manifest_file_path.write_text(data="\n".join(non_hidden_files))
-
-
-def _get_current_branch(cwd: pathlib.Path) -> str:
-    branch_command = "git branch"
-    branches = _deploy_subprocess(command=branch_command, cwd=cwd).strip().splitlines()
-    for branch in branches:
-        if branch.startswith("*"):
-            current_branch = branch.removeprefix("* ").strip()
-            break
-    return current_branch
-
-
-def _configure_git_repo(repo_directory: pathlib.Path) -> None:
-    _deploy_subprocess(
-        command='git config --local user.email "github-actions[bot]@users.noreply.github.com"', cwd=repo_directory
-    )
-    _deploy_subprocess(command='git config --local user.name "github-actions[bot]"', cwd=repo_directory)
+    _write_if_changed(file_path=run_info_file_path, data=json.dumps(obj=dandiset_run_info, indent=2).encode())
+
+
+def _write_if_changed(file_path: pathlib.Path, data: bytes) -> bool:
+    # Leaving identical files untouched keeps their stat data, so `git status` does not need to re-hash them
+    if file_path.exists() and file_path.read_bytes() == data:
+        return False
+
+    file_path.write_bytes(data=data)
+    return True
+
+
+def _prune_directory(directory: pathlib.Path, keep: set[pathlib.Path]) -> None:
+    for root, directory_names, file_names in os.walk(top=directory, topdown=False):
+        root_path = pathlib.Path(root)
+        for name in file_names:
+            file_path = root_path / name
+            if file_path not in keep:
+                file_path.unlink()
+        for name in directory_names:
+            if (root_path / name).is_symlink():
+                (root_path / name).unlink()
+
+        if root_path != directory and not any(root_path.iterdir()):
+            root_path.rmdir()
+
+
+def _fast_walk(root: pathlib.Path) -> collections.abc.Iterator[tuple[str, bool, str]]:
+    # Same top-down order as `pathlib.Path.walk`, but `os.scandir` reports entry types without a `stat` per entry
+    # Hidden entries (.git, .datalad, .nwb2bids, ...) are pruned rather than descended into
+    directories = [""]
+    while len(directories) > 0:
+        relative_directory = directories.pop()
+
+        subdirectories = []
+        with os.scandir(root / relative_directory) as entries:
+            for entry in entries:
+                if entry.name.startswith("."):
+                    continue
+
+                relative_path = f"{relative_directory}/{entry.name}" if relative_directory != "" else entry.name
+                is_directory = entry.is_dir(follow_symlinks=False)
+                if is_directory:
+                    subdirectories.append(relative_path)
+
+                yield relative_path, is_directory, entry.name
+        directories.extend(reversed(subdirectories))
+
+
+def _remove_entry(entry: os.DirEntry) -> None:
+    # The entry type was already reported by `os.scandir`, so no further `stat` is needed
+    if entry.is_dir(follow_symlinks=False):
+        shutil.rmtree(path=entry.path)
+    else:
+        os.unlink(path=entry.path)
+
+
+def _remove_entries(entries: collections.abc.Collection[os.DirEntry]) -> None:
+    if len(entries) == 0:
+        return
+
+    # Unlinking is syscall-bound and releases the GIL, so threads overlap the deletion of independent subtrees
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(8, len(entries))) as executor:
+        collections.deque(executor.map(_remove_entry, entries), maxlen=0)
 
 
 def _push_changes(repo_directory: pathlib.Path, branch_name: str) -> None:
-    _deploy_subprocess(command="git add .", cwd=repo_directory)
-    _deploy_subprocess(command='git commit --message "update"', cwd=repo_directory, ignore_errors=True)
+    # Nothing to commit means nothing to push, so skip the round trip to GitHub entirely
+    status = _common.deploy_subprocess(command=["git", "-C", str(repo_directory), "status", "--porcelain"])
+    if status.strip() == "":
+        print("\tNo changes to push...")
+        return
+
+    _common.deploy_subprocess(command=["git", "-C", str(repo_directory), "add", "--all"], capture_stdout=False)
+    _common.deploy_subprocess(
+        command=["git", "-C", str(repo_directory), *_common.GIT_IDENTITY_OPTIONS, "commit", "--message", "update"],
+        capture_stdout=False,
+    )
 
     if branch_name == "draft":
         print("\tPushing changes to draft branch...")
 
-        _deploy_subprocess(command="git push", cwd=repo_directory)
+        _common.deploy_subprocess(command=["git", "-C", str(repo_directory), "push"], capture_stdout=False)
     else:
-        output = _deploy_subprocess(
-            command="git push", cwd=repo_directory, return_combined_output=True, ignore_errors=True
+        output = _common.deploy_subprocess(
+            command=["git", "-C", str(repo_directory), "push"], return_combined_output=True, ignore_errors=True
         )
         if "fatal" in output:
-            output = _deploy_subprocess(command=f"git push --set-upstream origin {branch_name}", cwd=repo_directory)
+            output = _common.deploy_subprocess(
+                command=["git", "-C", str(repo_directory), "push", "--set-upstream", "origin", branch_name]
+            )
         if "fatal" in output:
             message = f"Could not push branch {branch_name}!"
             raise RuntimeError(message)
 
-    push_command = "git push" if branch_name == "draft" else f"git push --set-upstream origin {branch_name}"
-    _deploy_subprocess(command=push_command, cwd=repo_directory)
-
 
 if __name__ == "__main__":
     import argparse
@@ -434,8 +882,8 @@ if __name__ == "__main__":
     parser.add_argument(
         "--workers",
         type=int,
-        default=None,
-        help="Maximum number of workers to use (default: None)",
+        default=MAX_WORKERS,
+        help="Maximum number of workers to use (default: $BIDS_DANDISETS_MAX_WORKERS or None)",
     )
     parser.add_argument(
         "--limit",
@@ -455,9 +903,20 @@ if __name__ == "__main__":
         default=False,
         help="Whether to force update even if up to date (default: False)",
     )
+    parser.add_argument(
+        "--refresh-cache",
+        action="store_true",
+        help="Re-list the NWB Dandisets even if the cached listing is still fresh",
+    )
     args = parser.parse_args()
 
-    run(max_workers=args.workers, limit=args.limit, branch_name=args.branch, force=args.force)
+    run(
+        max_workers=args.workers,
+        limit=args.limit,
+        branch_name=args.branch,
+        force=args.force,
+        refresh_cache=args.refresh_cache,
+    )
 
 # Cody's debugging
 # if __name__ == "__main__":
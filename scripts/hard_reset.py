@@ -1,10 +1,10 @@
 import os
 import pathlib
 import shutil
-import subprocess
+import threading
 
-import dandi.dandiapi
-import requests
+import _cache
+import _common
 
 GITHUB_TOKEN = os.environ.get("GITHUB_TOKEN", None)
 if GITHUB_TOKEN is None:
@@ -13,75 +13,50 @@ if GITHUB_TOKEN is None:
 
 BASE_GITHUB_API_URL = "https://api.github.com/repos"
 BASE_DIRECTORY = pathlib.Path("E:/GitHub/bids-dandisets")
-authentication_header = {"Authorization": f"token {GITHUB_TOKEN}"}
 
+# GitHub applies secondary rate limits to destructive requests, so only a couple of deletions are sent at once
+_DELETE_SEMAPHORE = threading.Semaphore(value=2)
 
-def _deploy_subprocess(
-    *,
-    command: str | list[str],
-    cwd: str | pathlib.Path | None = None,
-    environment_variables: dict[str, str] | None = None,
-    error_message: str | None = None,
-    ignore_errors: bool = False,
-) -> str | None:
-    error_message = error_message or "An error occurred while executing the command."
 
-    result = subprocess.run(
-        args=command,
-        cwd=cwd,
-        shell=True,
-        env=environment_variables,
-        capture_output=True,
-        text=True,
-        encoding="utf-8",
-    )
-    if result.returncode != 0 and ignore_errors is False:
-        message = (
-            f"\n\nError code {result.returncode}\n"
-            f"{error_message}\n\n"
-            f"stdout: {result.stdout}\n\n"
-            f"stderr: {result.stderr}\n\n"
-        )
-        raise RuntimeError(message)
-    if result.returncode != 0 and ignore_errors is True:
-        return None
+def reset_github_repos() -> None:
+    # A reset is rare and destructive, so it always works from a fresh listing rather than a cached one
+    dandiset_ids = _cache.get_dandiset_ids(refresh=True)
 
-    return result.stdout
+    # Each reset is a couple of GitHub requests and a local removal, so they are overlapped on threads
+    _common.run_until_first_failure(function=_reset_dandiset, arguments=dandiset_ids, max_workers=8)
 
 
-def reset_github_repos() -> None:
-    client = dandi.dandiapi.DandiAPIClient()
-    dandisets = client.get_dandisets()
+def _reset_dandiset(dandiset_id: str) -> None:
+    # One keep-alive connection pool to the GitHub API is shared by every lookup and deletion
+    session = _common.get_session(github_token=GITHUB_TOKEN)
+    repo_directory = BASE_DIRECTORY / dandiset_id
 
-    for dandiset in dandisets:
-        dandiset_id = dandiset.identifier
-        repo_directory = BASE_DIRECTORY / dandiset_id
+    print(f"Cleaning Dandiset {dandiset_id}...")
+    if repo_directory.exists():
+        print("\tCleaning local directory...")
+        shutil.rmtree(path=repo_directory)
 
-        print(f"Cleaning Dandiset {dandiset_id}...")
-        if repo_directory.exists():
-            print("\tCleaning local directory...")
-            shutil.rmtree(path=repo_directory)
+    repo_name = f"bids-dandisets/{dandiset_id}"
+    repo_api_url = f"{BASE_GITHUB_API_URL}/{repo_name}"
+    response = session.get(url=repo_api_url)
 
-        repo_name = f"bids-dandisets/{dandiset_id}"
-        repo_api_url = f"{BASE_GITHUB_API_URL}/{repo_name}"
-        response = requests.get(url=repo_api_url, headers=authentication_header)
+    if response.status_code == 404:
+        print(f"\tRepository for {dandiset_id} does not exist. Skipping...")
+        return
 
-        if response.status_code == 404:
-            print(f"\tRepository for {dandiset_id} does not exist. Skipping...")
-            continue
-
-        if response.status_code == 200:
-            print("\tCleaning repository...")
-            delete_response = requests.delete(url=repo_api_url, headers=authentication_header)
-            if delete_response.status_code == 204:
-                print(f"\tRepository {repo_name} deleted successfully.")
-            else:
-                message = f"{delete_response.status_code}: {delete_response.text}"
-                raise RuntimeError(message)
+    if response.status_code == 200:
+        print("\tCleaning repository...")
+        with _DELETE_SEMAPHORE:
+            delete_response = session.delete(url=repo_api_url)
+        if delete_response.status_code == 204:
+            print(f"\tRepository {repo_name} deleted successfully.")
         else:
-            message = f"{response.status_code}: {response.text}"
+            message = f"{delete_response.status_code}: {delete_response.text}"
             raise RuntimeError(message)
-        print("Cleaning complete!\n\n")
+    else:
+        message = f"{response.status_code}: {response.text}"
+        raise RuntimeError(message)
+    print("Cleaning complete!\n\n")
 
 
 if __name__ == "__main__":
